@@ -33,5 +33,7 @@ login_manager.init_app(app)
 login_manager.login_view = 'users_bp.login'
 
 # Initializing hash function and iterations for Pbkdf2 hashing
+# ITERATIONS is the password work factor. Passwords are hashed twice, so a login costs 2 * ITERATIONS rounds.
+# Iterations are not stored with the hash: changing the value invalidates every registered password
 HASH_FUNCTION = 'sha256'
 ITERATIONS = 100000
@@ -3,12 +3,35 @@
 Db Connection Configuration and Context Manager
 """
 
+import threading
+
 import pymongo
 from contextlib import contextmanager
 
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 27017
+
+# long-lived client for default connection parameters, PyMongo pools its connections
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def _shared_client():
+    """
+    Returns MongoClient shared between calls with default parameters, created on first use
+
+    :return: Mongo Client
+    :rtype: pymongo.MongoClient
+    """
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = pymongo.MongoClient(DEFAULT_HOST, DEFAULT_PORT)
+    return _CLIENT
+
 
 @contextmanager
-def connect(db_name, host='localhost', port=27017, **kwargs):
+def connect(db_name, host=DEFAULT_HOST, port=DEFAULT_PORT, **kwargs):
     """
     Context Manger for Mongo Database Connection
     :param db_name: name for DB for connection establishment
@@ -21,7 +44,12 @@ def connect(db_name, host='localhost', port=27017, **kwargs):
     :return: generator with Mongo Collection object
 
     .. note:: username={value} and password={value} must be provided in kwargs for secure connection
+    .. note:: with default host, port and no kwargs the client is shared and stays open,
+              other parameters get a client that is closed on exit
     """
+    if host == DEFAULT_HOST and port == DEFAULT_PORT and not kwargs:
+        yield _shared_client().get_database(db_name)
+        return
     m_client = pymongo.MongoClient(host, port, **kwargs)
     try:
         db_instance = m_client.get_database(db_name)
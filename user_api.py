@@ -3,35 +3,56 @@
 User API module for Registration and Login
 """
 import datetime
+import functools
+import re
+from concurrent.futures import ThreadPoolExecutor
 import flask
 from flask_login import login_required, login_user
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField
-from wtforms.validators import DataRequired, Email, Length, EqualTo
+from wtforms.validators import DataRequired, Length, EqualTo, ValidationError
 
 import itsdangerous
 import hashlib
+import hmac
 
 import db
 import config
-from user_model import UserModel, generate_salt
+from user_model import UserModel, generate_salt, ensure_indexes, CREDENTIALS_PROJECTION
 
 from magen_gmail_client_api import gmail_client
 
+# salt and hash checked for unknown emails on login. Hash never matches a generated hex digest
+_DUMMY_SALT = generate_salt()
+_DUMMY_HASH = ''
+
+# background workers for sending confirmation letters
+EMAIL_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
 # creating blueprints
 users_bp = flask.Blueprint('users_bp', __name__)
 main_bp = flask.Blueprint('main_bp', __name__)
 
 
+_EMAIL_RE = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s]+')
+
+
+def _email_format(form, field):
+    """ Validate email format with precompiled pattern """
+    if not _EMAIL_RE.fullmatch(field.data or ''):
+        raise ValidationError('Invalid email address.')
+
+
+# validators are stateless and shared between forms
+_EMAIL_VALIDATORS = (DataRequired(), _email_format, Length(min=6, max=40))
+_PASSWORD_VALIDATORS = (DataRequired(), Length(min=6, max=25))
+_LOGIN_EMAIL_VALIDATORS = (DataRequired(), _email_format)
+
+
 class RegistrationForm(FlaskForm):
     """ Class represents Registration Form for user """
-    email = StringField(
-        'email',
-        validators=[DataRequired(), Email(message=None), Length(min=6, max=40)])
-    password = PasswordField(
-        'password',
-        validators=[DataRequired(), Length(min=6, max=25)]
-    )
+    email = StringField('email', validators=_EMAIL_VALIDATORS)
+    password = PasswordField('password', validators=_PASSWORD_VALIDATORS)
     confirm = PasswordField(
         'Repeat password',
         validators=[
@@ -40,24 +61,17 @@ class RegistrationForm(FlaskForm):
         ]
     )
 
-    def validate(self):
-        """ Validate that user has unique email """
-        initial_validation = super(RegistrationForm, self).validate()
-        if not initial_validation:
-            return False
-        with db.connect(config.DEV_DB_NAME) as db_instance:
-            result = UserModel.select_by_email(db_instance, self.email.data)
-        if not result.success:
-            if result.code == config.EXISTING_EMAIL_CODE_ERR:
-                self.email.errors.append("Email already registered")
-            return False
-        return True
-
 
 class LoginForm(FlaskForm):
     """ Class represents Login Form for user """
-    email = StringField('email', validators=[DataRequired(), Email()])
-    password = PasswordField('password', validators=[DataRequired()])
+    email = StringField('email', validators=_LOGIN_EMAIL_VALIDATORS)
+    password = PasswordField('password', validators=(DataRequired(),))
+
+
+@functools.lru_cache(maxsize=None)
+def _serializer(secret_key):
+    """ Returns token serializer for a secret key, created once per key """
+    return itsdangerous.URLSafeTimedSerializer(secret_key)
 
 
 def generate_confirmation_token(email):
@@ -70,8 +84,7 @@ def generate_confirmation_token(email):
     :return: generated token
     :rtype: str
     """
-    serializer = itsdangerous.URLSafeTimedSerializer(config.app.config['SECRET_KEY'] )
-    return serializer.dumps(email, salt=config.app.config['SECURITY_PASSWORD_SALT'])
+    return _serializer(config.app.config['SECRET_KEY']).dumps(email, salt=config.app.config['SECURITY_PASSWORD_SALT'])
 
 
 def confirm_token(token, expiration=3600):
@@ -86,33 +99,51 @@ def confirm_token(token, expiration=3600):
     :return: email or False
     :rtype: str or bool
     """
-    serializer = itsdangerous.URLSafeTimedSerializer(config.app.config['SECRET_KEY'])
     try:
-        email = serializer.loads(
+        email = _serializer(config.app.config['SECRET_KEY']).loads(
             token,
             salt=config.app.config['SECURITY_PASSWORD_SALT'],
             max_age=expiration
         )
-    except itsdangerous.BadSignature as err:
+    except itsdangerous.BadData as err:
         print(err)
         return False
     return email
 
 
+def generate_password_hash(password, salt):
+    """
+    Generate double Pbkdf2 hash of a password.
+    Uses OpenSSL-backed hashlib.pbkdf2_hmac, which runs natively (SHA extensions where available)
+
+    :param password: user password
+    :type password: bytes
+    :param salt: random value
+    :type salt: str
+
+    :return: hex digest of the password hash
+    :rtype: str
+    """
+    salt = salt.encode('utf-8')
+    password_hash = hashlib.pbkdf2_hmac(config.HASH_FUNCTION, password, salt, config.ITERATIONS)
+    return hashlib.pbkdf2_hmac(config.HASH_FUNCTION, password_hash, salt, config.ITERATIONS).hex()
+
+
 def check_password_hash(pw_hash, salt, password):
     """
+    Check password against stored hash
 
-    :param pw_hash:
-    :param salt:
-    :param password:
-    :return:
+    :param pw_hash: stored password hash
+    :type pw_hash: str
+    :param salt: salt used for the stored hash
+    :type salt: str
+    :param password: password to check
+    :type password: bytes
+
+    :return: True if password matches
+    :rtype: bool
     """
-    password_hash = hashlib.pbkdf2_hmac(config.HASH_FUNCTION, password, salt.encode('utf-8'), config.ITERATIONS)
-    password_double_hash = hashlib.pbkdf2_hmac(config.HASH_FUNCTION, password_hash,
-                                               salt.encode('utf-8'), config.ITERATIONS).hex()
-    if pw_hash == password_double_hash:
-        return True
-    return False
+    return hmac.compare_digest(pw_hash, generate_password_hash(password, salt))
 
 
 def send_confirmation(user_email):
@@ -142,6 +173,18 @@ def send_confirmation(user_email):
     return msg
 
 
+def _log_send_failure(future):
+    """
+    Log error of a confirmation letter sent in background
+
+    :param future: finished send_confirmation call
+    :type future: concurrent.futures.Future
+    """
+    error = future.exception()
+    if error is not None:
+        config.app.logger.error('Failed to send confirmation letter', exc_info=error)
+
+
 @users_bp.route('/register/', methods=['GET', 'POST'])
 def register():
     """ Registration of a user """
@@ -150,19 +193,21 @@ def register():
         if form.validate_on_submit():
             email = form.email.data
             salt = generate_salt()
-            hash_password = hashlib.pbkdf2_hmac(config.HASH_FUNCTION, form.password.data.encode('utf-8'),
-                                                salt.encode('utf-8'), config.ITERATIONS)
-            password = hashlib.pbkdf2_hmac(config.HASH_FUNCTION, hash_password,
-                                           salt.encode('utf-8'), config.ITERATIONS).hex()
+            password = generate_password_hash(form.password.data.encode('utf-8'), salt)
             # Here goes additional stuff from the form
             user_data = {}
             with db.connect(config.DEV_DB_NAME) as db_instance:
                 user = UserModel(db_instance, email, password, salt, **user_data)
-                result = user.submit()
+                result = user.insert()
             if result.success:
-                send_confirmation(email)
-                flask.flash('A confirmation email has been sent via email.', 'success')
+                # token and letter are produced in background, request context is needed for url_for
+                future = EMAIL_EXECUTOR.submit(flask.copy_current_request_context(send_confirmation), email)
+                future.add_done_callback(_log_send_failure)
+                flask.flash('A confirmation email will be sent shortly.', 'success')
                 return flask.redirect(flask.url_for('main_bp.home'))
+            elif result.code == config.EXISTING_EMAIL_CODE_ERR:
+                flask.flash('Email already registered')
+                return flask.render_template('registration.html', form=form)
             else:
                 flask.flash('Failed to insert document')
                 return flask.render_template('registration.html', form=form)
@@ -177,21 +222,19 @@ def login():
     if flask.request.method == 'POST':
         if form.validate_on_submit():
             with db.connect(config.DEV_DB_NAME) as db_instance:
-                result = UserModel.select_by_email(db_instance, str(form.email.data))
-            if result.count:
-                user = result.documents
-                if check_password_hash(user.password, user.salt, form.password.data.encode('utf-8')):
+                result = UserModel.select_by_email(db_instance, form.email.data, CREDENTIALS_PROJECTION)
+                user = result.documents if result.count else None
+                # password is hashed for unknown emails too, so response time doesn't reveal registered users
+                pw_hash, salt = (user.password, user.salt) if user else (_DUMMY_HASH, _DUMMY_SALT)
+                password_valid = check_password_hash(pw_hash, salt, form.password.data.encode('utf-8'))
+                if user and password_valid:
                     login_user(user)
                     flask.flash('Welcome.', 'success')
                     user._is_authenticated = True
                     user.submit()
                     return flask.redirect(flask.url_for('main_bp.home'))
-                else:
-                    flask.flash('Invalid email and/or password.', 'danger')
-                    return flask.render_template('login.html', form=form), 403
-            else:
-                flask.flash('Invalid email and/or password.', 'danger')
-                return flask.render_template('login.html', form=form), 403
+            flask.flash('Invalid email and/or password.', 'danger')
+            return flask.render_template('login.html', form=form), 403
     return flask.render_template('login.html', form=form)
 
 
@@ -215,20 +258,33 @@ def confirm_email(token):
         return flask.redirect(flask.url_for('main_bp.home'))
     with db.connect(db_name=config.DEV_DB_NAME) as db_instance:
         result = UserModel.select_by_email(db_instance, email)
-    if result.count:
-        user = result.documents
-        if user.confirmed:
-            flask.flash('User is already confirmed, please login')
-            return flask.redirect(flask.url_for('user_bp.login'))
-        user._is_authenticated = True
-        user.confirmed = True
-        user.confirmed_on = datetime.datetime.now()
-        user.submit()
-        login_user(user)
-        flask.flash('You have confirmed your account. Thanks!', 'success')
+        if result.count:
+            user = result.documents
+            if user.confirmed:
+                flask.flash('User is already confirmed, please login')
+                return flask.redirect(flask.url_for('user_bp.login'))
+            user._is_authenticated = True
+            user.confirmed = True
+            user.confirmed_on = datetime.datetime.now()
+            user.submit()
+            login_user(user)
+            flask.flash('You have confirmed your account. Thanks!', 'success')
     return flask.redirect(flask.url_for('main_bp.home'))
 
 
+@users_bp.record_once
+def create_indexes(state):
+    """
+    Create users indexes when the blueprint is registered on an application,
+    so every way of starting the app gets them
+
+    :param state: blueprint registration state
+    :type state: flask.blueprints.BlueprintSetupState
+    """
+    with db.connect(config.DEV_DB_NAME) as db_instance:
+        ensure_indexes(db_instance)
+
+
 @config.login_manager.user_loader
 def load_user(user_id):
     """
@@ -247,5 +303,8 @@ def load_user(user_id):
 if __name__ == "__main__":
     config.app.register_blueprint(users_bp)
     config.app.register_blueprint(main_bp)
+    with db.connect(config.DEV_DB_NAME) as db_instance:
+        # warm up server discovery and connection pool before the first request
+        db_instance.command('ping')
     config.app.run('0.0.0.0', port=5005)
 
@@ -4,15 +4,34 @@ User Model. Users Mongo Database Interface
 """
 
 import pymongo
+import threading
 import unittest
 
+from cachetools import TTLCache
+from pymongo.write_concern import WriteConcern
+
 from magen_utils_apis.datetime_api import SimpleUtc
-from magen_mongo_apis.mongo_return import MongoReturn
 
 import db
 import uuid
 from config import TEST_DB_NAME, USER_COLLECTION_NAME
 
+# fields required to authenticate and re-submit a user, leaves out user's details
+CREDENTIALS_PROJECTION = dict(_id=False, email=True, password=True, salt=True, _is_authenticated=True,
+                              _is_anonymous=True, _is_active=True, confirmed=True, confirmed_on=True)
+
+# short-lived cache of user documents keyed by (db name, email), saves repeated lookups on login.
+# Each entry maps projection (None for full document) to the fetched document
+_EMAIL_CACHE = TTLCache(maxsize=10000, ttl=5)
+_EMAIL_CACHE_LOCK = threading.Lock()
+# cached marker of an email without user, cleared by insert
+_NOT_FOUND = object()
+
+_UTC = SimpleUtc()
+
+# registration insert is acknowledged without waiting for journal, a lost registration is retried by the user
+_WRITE_CONCERN = WriteConcern(w=1, j=False)
+
 
 def generate_salt():
     """ Returns generated salt value"""
@@ -20,22 +39,47 @@ def generate_salt():
     return salt
 
 
-def _cursor_helper(cursor):
-    """ Returns processed list"""
-    result = list()
-    for cur in cursor:
-        if cur.get("creation_timestamp"):
-            cur["creation_timestamp"] = cur["creation_timestamp"].replace(
-                tzinfo=SimpleUtc()).isoformat()
-        result.append(cur)
-    return result
+def ensure_indexes(db_instance):
+    """
+    Create indexes for users collection. Called once on application start
+
+    :param db_instance: Database context
+    :type db_instance: PyMongo.MongoClient.Database
+    """
+    db_instance.get_collection(USER_COLLECTION_NAME).create_index('email', unique=True)
+
+
+def _fix_timestamp(document):
+    """ Returns document with creation timestamp converted to UTC iso format"""
+    timestamp = document.get("creation_timestamp")
+    if timestamp:
+        document["creation_timestamp"] = timestamp.replace(tzinfo=_UTC).isoformat()
+    return document
+
+
+class FastMongoReturn(object):
+    """
+    Return Object of Database operations.
+    Same attributes as magen_mongo_apis MongoReturn, stored in slots
+    """
+    __slots__ = ('success', 'count', 'matched_count', 'code', 'message', 'documents', 'db_exception')
+
+    def __init__(self):
+        self.success = False
+        self.count = 0
+        self.matched_count = 0
+        self.code = 0
+        self.message = None
+        self.documents = None
+        self.db_exception = None
 
 
 class UserModel(object):
     """
     User Model represents a User Entity
     """
-    created_index = False
+    __slots__ = ('db_ctx', 'email', 'password', 'salt', '_is_authenticated', '_is_anonymous', '_is_active',
+                 'confirmed', 'confirmed_on', 'details')
 
     def __init__(self, db_ctx, email, password, salt, _is_authenticated=False, **kwargs):
         """
@@ -93,11 +137,17 @@ class UserModel(object):
         :return: flat dictionary with properties
         :rtype: dict
         """
-        attributes = vars(self)
-        attributes.pop('db_ctx')
-        for detail in attributes['details']:
-            attributes[detail] = attributes['details'][detail]
-        del attributes['details']
+        attributes = {
+            'email': self.email,
+            'password': self.password,
+            'salt': self.salt,
+            '_is_authenticated': self._is_authenticated,
+            '_is_anonymous': self._is_anonymous,
+            '_is_active': self._is_active,
+            'confirmed': self.confirmed,
+            'confirmed_on': self.confirmed_on
+        }
+        attributes.update(self.details)
         return attributes
 
     def submit(self):
@@ -110,11 +160,12 @@ class UserModel(object):
         :rtype: Object
         """
         user_collection = self.db_ctx.get_collection(USER_COLLECTION_NAME)
-        if not type(self).created_index:
-            user_collection.create_index('email', unique=True)
-        return_obj = MongoReturn()
+        cache_key = (self.db_ctx.name, self.email)
+        return_obj = FastMongoReturn()
         try:
             result = user_collection.update_one({'email': self.email}, {"$set": self._to_dict()}, upsert=True)
+            with _EMAIL_CACHE_LOCK:
+                _EMAIL_CACHE.pop(cache_key, None)
             if result.acknowledged and result.upserted_id:
                 return_obj.success = True
                 return_obj.count = 1
@@ -136,8 +187,45 @@ class UserModel(object):
             return_obj.db_exception = error
             return return_obj
 
+    def insert(self):
+        """
+        Insert a new user into Database.
+        Uniqueness of email is guaranteed by the unique index,
+        an existing email is reported with config.EXISTING_EMAIL_CODE_ERR code
+
+        :return: Return Object
+        :rtype: Object
+        """
+        user_collection = self.db_ctx.get_collection(USER_COLLECTION_NAME, write_concern=_WRITE_CONCERN)
+        return_obj = FastMongoReturn()
+        try:
+            result = user_collection.insert_one(self._to_dict())
+            with _EMAIL_CACHE_LOCK:
+                _EMAIL_CACHE.pop((self.db_ctx.name, self.email), None)
+            if result.acknowledged:
+                return_obj.success = True
+                return_obj.count = 1
+                return_obj.message = 'Document inserted successfully'
+            else:
+                return_obj.success = False
+                return_obj.count = 0
+                return_obj.message = "Failed to insert document"
+            return return_obj
+        except pymongo.errors.OperationFailure as error:
+            return_obj.success = False
+            return_obj.code = error.code
+            return_obj.message = error.details
+            return_obj.db_exception = error
+            return return_obj
+        except pymongo.errors.PyMongoError as error:
+            # connection errors carry no server code or details
+            return_obj.success = False
+            return_obj.message = str(error)
+            return_obj.db_exception = error
+            return return_obj
+
     @classmethod
-    def select_by_email(cls, db_instance, email):
+    def select_by_email(cls, db_instance, email, projection=None):
         """
         Select a User by email
 
@@ -145,24 +233,49 @@ class UserModel(object):
 
         :param email: user's e-mail
         :type email: str
+        :param projection: fields to fetch, all fields if not provided
+        :type projection: dict
 
         :return: found users or empty list
-        :rtype: MongoReturn
+        :rtype: FastMongoReturn
         """
+        cache_key = (db_instance.name, email)
+        projection_key = tuple(sorted(projection.items())) if projection is not None else None
+        mongo_return = FastMongoReturn()
+        with _EMAIL_CACHE_LOCK:
+            cached = _EMAIL_CACHE.get(cache_key, {})
+            # cached full document serves any projection
+            document = cached.get(None) or cached.get(projection_key)
+        if document is _NOT_FOUND:
+            mongo_return.success = True
+            mongo_return.count = 0
+            return mongo_return
+        if document is not None:
+            mongo_return.success = True
+            mongo_return.documents = cls(db_instance, **document)
+            mongo_return.count = 1
+            return mongo_return
+
         user_collection = db_instance.get_collection(USER_COLLECTION_NAME)
 
         seed = dict(email=email)
-        projection = dict(_id=False)
+        if projection is None:
+            projection = dict(_id=False)
 
-        mongo_return = MongoReturn()
         try:
-            cursor = user_collection.find(seed, projection)
-            result = _cursor_helper(cursor)
-            assert len(result) == 1 or len(result) == 0
+            document = user_collection.find_one(seed, projection)  # email is unique index
             mongo_return.success = True
-            if len(result):
-                mongo_return.documents = cls(db_instance, **result[0])  # email is unique index
-            mongo_return.count = len(result)
+            if document:
+                _fix_timestamp(document)
+                mongo_return.documents = cls(db_instance, **document)
+            # unknown emails are cached as well, so known and unknown emails cost the same.
+            # authenticated users are not cached, their session state must stay fresh
+            if not document or not document.get('_is_authenticated'):
+                with _EMAIL_CACHE_LOCK:
+                    cached = _EMAIL_CACHE.get(cache_key, {})
+                    cached[projection_key] = dict(document) if document else _NOT_FOUND
+                    _EMAIL_CACHE[cache_key] = cached
+            mongo_return.count = 1 if document else 0
             return mongo_return
         except pymongo.errors.PyMongoError as error:
             mongo_return.success = False
@@ -177,8 +290,10 @@ class TestUserDB(unittest.TestCase):
     """
 
     def setUp(self):
+        _EMAIL_CACHE.clear()
         with db.connect(TEST_DB_NAME) as db_instance:
             db_instance.drop_collection(USER_COLLECTION_NAME)
+            ensure_indexes(db_instance)
 
     def tearDown(self):
         with db.connect(TEST_DB_NAME) as db_instance:
@@ -232,6 +347,12 @@ class TestUserDB(unittest.TestCase):
         self.assertEqual(user['first_name'], user_details['first_name'])
         self.assertEqual(user['last_name'], user_details['last_name'])
 
+        # same object can be submitted again
+        with db.connect(TEST_DB_NAME) as db_instance:
+            result_obj = user_obj.submit()
+        self.assertTrue(result_obj.success)
+        self.assertEqual(user_obj.details, user_details)
+
     def test_select_by_email(self):
         """
         Select user by email (unique value)
@@ -265,3 +386,38 @@ class TestUserDB(unittest.TestCase):
         self.assertEqual(result_obj.count, 1)
         user_obj = result_obj.documents
         self.assertEqual(user_obj.email, test_email)
+
+        # Select credentials only
+        _EMAIL_CACHE.clear()
+        with db.connect(TEST_DB_NAME) as db_instance:
+            result_obj = UserModel.select_by_email(db_instance, test_email, CREDENTIALS_PROJECTION)
+        self.assertEqual(result_obj.count, 1)
+        self.assertEqual(result_obj.documents.password, test_password)
+        self.assertEqual(result_obj.documents.details, {})
+
+        # cached credentials don't serve a full document
+        with db.connect(TEST_DB_NAME) as db_instance:
+            result_obj = UserModel.select_by_email(db_instance, test_email)
+        self.assertEqual(result_obj.documents.details, user_details)
+
+    def test_select_by_email_cache(self):
+        """
+        Select user by email served from cache until the user is submitted
+        """
+        test_email = 'test@test.com'
+        test_salt = generate_salt()
+
+        with db.connect(TEST_DB_NAME) as db_instance:
+            UserModel(db_instance, test_email, 'test_password', test_salt).submit()
+            UserModel.select_by_email(db_instance, test_email)
+
+            # change made behind the model is not seen while cached
+            user_collection = db_instance.get_collection(USER_COLLECTION_NAME)
+            user_collection.update_one({'email': test_email}, {'$set': {'password': 'changed'}})
+            result_obj = UserModel.select_by_email(db_instance, test_email)
+            self.assertEqual(result_obj.documents.password, 'test_password')
+
+            # submit invalidates cached user
+            UserModel(db_instance, test_email, 'new_password', test_salt).submit()
+            result_obj = UserModel.select_by_email(db_instance, test_email)
+            self.assertEqual(result_obj.documents.password, 'new_password')
@@ -3,11 +3,16 @@
 
 import http
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
+import flask
+import pymongo
+
 import db
 import user_api
 import config
+import user_model
 from user_model import UserModel
 
 
@@ -23,8 +28,10 @@ class TestUser(unittest.TestCase):
         config.app.register_blueprint(user_api.main_bp)
 
         self.test_app = config.app.test_client()
+        user_model._EMAIL_CACHE.clear()
         with db.connect(config.TEST_DB_NAME) as db_instance:
             db_instance.drop_collection(config.USER_COLLECTION_NAME)
+            user_model.ensure_indexes(db_instance)
         config.DEV_DB_NAME = config.TEST_DB_NAME
 
     def tearDown(self):
@@ -59,6 +66,63 @@ class TestUser(unittest.TestCase):
             )
         self.assertIsNot(data2['password'],  data2['confirm'])
 
+    def test_register_IndexCreatedOnBlueprintRegistration(self):
+        # collection without indexes
+        with db.connect(config.TEST_DB_NAME) as db_instance:
+            db_instance.drop_collection(config.USER_COLLECTION_NAME)
+        # registering blueprint on a new application creates the unique index
+        flask.Flask(__name__).register_blueprint(user_api.users_bp)
+
+        data = {'email': 'test@test.com', 'password': 'testtest1', 'confirm': 'testtest1'}
+        with mock.patch('user_api.send_confirmation'):
+            self.test_app.post('/register/', data=data)
+            resp = self.test_app.post('/register/', data=data)
+        self.assertIn('Email already registered', resp.data.decode('utf-8'))
+
+    def test_register_SendsConfirmation(self):
+        data = {'email': 'test@test.com', 'password': 'testtest1', 'confirm': 'testtest1'}
+        executor = ThreadPoolExecutor(max_workers=1)
+        # Register user, letter is sent in background
+        with mock.patch('user_api.send_confirmation') as send_mock, \
+                mock.patch('user_api.EMAIL_EXECUTOR', executor):
+            self.test_app.post('/register/', data=data)
+            executor.shutdown(wait=True)
+        send_mock.assert_called_once_with(data['email'])
+
+    def test_register_SendFailureLogged(self):
+        data = {'email': 'test@test.com', 'password': 'testtest1', 'confirm': 'testtest1'}
+        executor = ThreadPoolExecutor(max_workers=1)
+        error = RuntimeError('gmail is down')
+        with mock.patch('user_api.send_confirmation', side_effect=error), \
+                mock.patch('user_api.EMAIL_EXECUTOR', executor), \
+                mock.patch.object(config.app.logger, 'error') as log_mock:
+            self.test_app.post('/register/', data=data)
+            executor.shutdown(wait=True)
+        log_mock.assert_called_once_with('Failed to send confirmation letter', exc_info=error)
+
+    def test_register_InvalidEmail(self):
+        data = {'email': 'test@test', 'password': 'testtest1', 'confirm': 'testtest1'}
+        with mock.patch('user_api.send_confirmation'):
+            resp = self.test_app.post('/register/', data=data)
+        self.assertEqual(resp.status_code, http.HTTPStatus.OK)
+        with db.connect(config.DEV_DB_NAME) as db_instance:
+            result = UserModel.select_by_email(db_instance, data['email'])
+            self.assertEqual(result.count, 0)
+
+    def test_register_ExistingEmail(self):
+        data = {'email': 'test@test.com', 'password': 'testtest1', 'confirm': 'testtest1'}
+        data2 = {'email': 'test@test.com', 'password': 'testtest2', 'confirm': 'testtest2'}
+        # Register user twice
+        with mock.patch('user_api.send_confirmation'):
+            self.test_app.post('/register/', data=data)
+            resp = self.test_app.post('/register/', data=data2)
+        self.assertIn('Email already registered', resp.data.decode('utf-8'))
+
+        # Existing user is not overwritten
+        with db.connect(config.DEV_DB_NAME) as db_instance:
+            user = UserModel.select_by_email(db_instance, data['email']).documents
+            self.assertTrue(user_api.check_password_hash(user.password, user.salt, data['password'].encode('utf-8')))
+
     def test_login(self):
         # Register user
         data = {'email': 'test@test.com', 'password': 'testtest1', 'confirm': 'testtest1'}
@@ -115,6 +179,41 @@ class TestUser(unittest.TestCase):
             self.assertFalse(user_api.check_password_hash(user.password, user.salt, post_data3['password'].encode('utf-8')))
             self.assertEqual(resp.status_code, http.HTTPStatus.FORBIDDEN)
 
+    def test_login_UnknownEmailHashesPassword(self):
+        # password is hashed for unknown email, response time doesn't reveal registered users
+        post_data = {'email': 'fail@test.com', 'password': 'testtest1'}
+        with mock.patch('user_api.generate_password_hash', wraps=user_api.generate_password_hash) as hash_mock:
+            resp = self.test_app.post('/login/', data=post_data)
+        hash_mock.assert_called_once_with(post_data['password'].encode('utf-8'), user_api._DUMMY_SALT)
+        self.assertEqual(resp.status_code, http.HTTPStatus.FORBIDDEN)
+
+    def test_login_InvalidEmail(self):
+        # invalid email format is rejected by the form, login page is rendered again
+        post_data = {'email': 'test at test.com', 'password': 'testtest1'}
+        resp = self.test_app.post('/login/', data=post_data)
+        self.assertEqual(resp.status_code, http.HTTPStatus.OK)
+
+        # long email is checked against database as any unknown email
+        post_data = {'email': 'a' * 40 + '@test.com', 'password': 'testtest1'}
+        resp = self.test_app.post('/login/', data=post_data)
+        self.assertEqual(resp.status_code, http.HTTPStatus.FORBIDDEN)
+
+    def test_login_FailedAttemptsCached(self):
+        data = {'email': 'test@test.com', 'password': 'testtest1', 'confirm': 'testtest1'}
+        with mock.patch('user_api.send_confirmation'):
+            self.test_app.post('/register/', data=data)
+
+        # Repeated failed attempts query the database once, for known and unknown emails alike
+        find_one = pymongo.collection.Collection.find_one
+        for email in ('test@test.com', 'fail@test.com'):
+            post_data = {'email': email, 'password': 'failtest1'}
+            with mock.patch.object(pymongo.collection.Collection, 'find_one', autospec=True,
+                                   side_effect=find_one) as find_one_mock:
+                for _ in range(2):
+                    resp = self.test_app.post('/login/', data=post_data)
+                    self.assertEqual(resp.status_code, http.HTTPStatus.FORBIDDEN)
+            self.assertEqual(find_one_mock.call_count, 1)
+
     def test_generate_confirm_token(self):
         """ Test token generation from user email """
         test_user_email = 'test@test.test'